@@ -4,26 +4,27 @@ from pathlib import Path
 from fastapi import FastAPI, Query
 from pydantic import BaseModel
 import uvicorn
+import msgspec
 from typing import List, Optional
-from pyrepositories import JsonTable, DataSource, Entity, IdTypes, FieldBase, FieldKeyTypes, FieldTypes
+from pyrepositories import DataSource, IdTypes, FieldBase, FieldKeyTypes, FieldTypes
 
 
 path_root = Path(__file__).parents[1]
 sys.path.append(os.path.join(path_root, 'src'))
 
-from crud import CRUDApi, Model, EntityFactory
+from crud import CRUDApi, EntityFactory, ORJSONResponse, TableStorage, create_table
 
 
-class Organizer(Model):
+class Organizer(msgspec.Struct):
     email: str
 
 
-class Joiner(Model):
+class Joiner(msgspec.Struct):
     name: str
     company: str
 
 
-class Event(Model):
+class Event(msgspec.Struct):
     date: str
     organizer: Organizer
     status: str
@@ -31,41 +32,11 @@ class Event(Model):
     joiners: Optional[List[Joiner]] = None
 
 
-class EventEntity(Entity):
-    @property
-    def date(self):
-        self.get_field("date")
-    @date.setter
-    def date(self, value):
-        self.set_field_value("date", value)
-    @property
-    def organizer(self):
-        return self.get_field("organizer")
-    @organizer.setter
-    def organizer(self, value):
-        self.set_field_value("organizer", value)
-    @property
-    def status(self):
-        return self.get_field("status")
-    @status.setter
-    def status(self, value):
-        self.set_field_value("status", value)
-    @property
-    def max_attendees(self):
-        return self.get_field("max_attendees")
-    @max_attendees.setter
-    def max_attendees(self, value):
-        self.set_field_value("max_attendees", value)
-    @property
-    def joiners(self):
-        return self.get_field("joiners")
-    @joiners.setter
-    def joiners(self, value):
-        self.set_field_value("joiners", value)
-
-
-
-app = FastAPI()
+if os.getenv("ENV") == "prod":
+    # No schema or docs in production, the routes are not walked for OpenAPI at all
+    app = FastAPI(openapi_url=None, docs_url=None, redoc_url=None)
+else:
+    app = FastAPI()
 
 ds = DataSource(id_type=IdTypes.UUID)
 
@@ -77,7 +48,9 @@ fields = [
     FieldBase("joiners", FieldTypes.LIST, FieldKeyTypes.OPTIONAL, [])
 ]
 
-t = JsonTable("event", os.path.join(path_root, "data"), fields)
+# STORAGE selects the table backend, see crud.TableStorage
+storage = TableStorage(os.getenv("STORAGE", TableStorage.INDEXED_JSON.value))
+t = create_table("event", os.path.join(path_root, "data"), fields, storage)
 filters = [
     FieldBase("date", FieldTypes.STR, FieldKeyTypes.OPTIONAL, ""),
     FieldBase("organizer", FieldTypes.STR, FieldKeyTypes.OPTIONAL, ""),
@@ -92,15 +65,26 @@ api = CRUDApi(ds, app)
 
 router = api.register_router("event" , Event, filters=filters).get_base()
 
-@router.get("/test", tags=["event"])
-def test():
-    return "test"
+# Encoded once, every hit sends the same bytes
+test_response = ORJSONResponse("test")
+
+@router.get("/test", tags=["event"], include_in_schema=False)
+async def test():
+    return test_response
 
 api.publish()
 
 
 
 if __name__ == "__main__":
-    uvicorn.run(app, host="0.0.0.0", port=1112)
+    # Make sure a request body converts to the entity that gets stored before serving
+    probe = Event("2024-01-01", Organizer("organizer@example.com"), "open", 10, [Joiner("joiner", "company")])
+    serialized = EntityFactory.from_model(fields, probe).serialize()
+    if serialized["date"] != "2024-01-01" or serialized["organizer"] != {"email": "organizer@example.com"} \
+            or serialized["joiners"] != [{"name": "joiner", "company": "company"}]:
+        raise RuntimeError(f"Event does not convert to the stored entity: {serialized}")
+
+    loop = "uvloop" if sys.platform != "win32" else "asyncio"
+    uvicorn.run(app, host="0.0.0.0", port=1112, loop=loop, http="httptools", access_log=False)
 
 
@@ -0,0 +1,22 @@
+import os
+from setuptools import setup
+
+# Set CRUD_COMPILE=1 to build the helper modules with Cython, the pure Python sources are shipped either way.
+# app.py stays interpreted: Cython stores annotations as strings, and FastAPI cannot resolve the
+# router-local model types (model_type, the filter query model) from them.
+ext_modules = []
+if os.environ.get('CRUD_COMPILE'):
+    from Cython.Build import cythonize
+
+    ext_modules = cythonize(
+        ['src/crud/entities.py', 'src/crud/lib.py', 'src/crud/responses.py'],
+        language_level=3,
+        compiler_directives={
+            'boundscheck': False,
+            'wraparound': False,
+            'binding': True,
+            'annotation_typing': False,
+        },
+    )
+
+setup(ext_modules=ext_modules)
@@ -1,5 +1,8 @@
 from .app import CRUDApi, CRUDApiRouter
 from .lib import Model
 from .entities import EntityFactory
+from .responses import ORJSONResponse
+from .tables import IndexedJsonTable, AppendLogTable, TableStorage, create_table, buffered_writes, insert_many
 
-__all__ = ['CRUDApi', 'CRUDApiRouter', 'Model', 'EntityFactory']
+__all__ = ['CRUDApi', 'CRUDApiRouter', 'Model', 'EntityFactory', 'ORJSONResponse', 'IndexedJsonTable', 'AppendLogTable',
+           'TableStorage', 'create_table', 'buffered_writes', 'insert_many']
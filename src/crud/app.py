@@ -1,15 +1,27 @@
-from typing import List
+import itertools
+import random
+import string
+import uuid
+import weakref
+from typing import Callable, List
 from enum import Enum
-from fastapi import Depends, FastAPI
-from pyrepositories import DataSource, Entity, FieldBase, FieldTypes
+from functools import lru_cache
+import anyio
+from fastapi import Body, Depends, FastAPI, Response
+from pyrepositories import DataSource, Entity, FieldBase, IdTypes
 from pydantic import create_model
 from fastapi.routing import APIRouter
-from .entities import EntityFactory
-from .lib import convert_field_to_filter, convert_dict_to_filter
+from .entities import EntityFactory, entity_to_json
+from .lib import convert_field_to_filter, create_filter_builder, is_struct_type, create_struct_decoder, create_struct_request_body
+from .responses import ORJSONResponse
+from .tables import AppendLogTable, buffered_writes, count_rows, insert_many
 
 id_path = '/single/{id}'
+cache_size = 256
+datasource_limiters = weakref.WeakKeyDictionary()  # type: weakref.WeakKeyDictionary[DataSource, anyio.CapacityLimiter]
 
 
+@lru_cache(maxsize=256)
 def construct_path(base_path: str, path: str, is_plural: bool, use_prefix: bool) -> str:
     plural = 's' if is_plural else ''
     if not use_prefix:
@@ -22,99 +34,261 @@ def get_tags(name: str, use_name_as_tag: bool) -> List[str | Enum] | None:
     return [name] if use_name_as_tag else []
 
 
+@lru_cache(maxsize=256)
 def get_prefix(name: str, use_prefix: bool) -> str:
     return f'/{name}' if use_prefix else ''
 
 
-def format_entities(entities: List[Entity]) -> List[dict]:
-    return [entity.serialize() for entity in entities]
+def dump_entities(entities: List[Entity | None]) -> bytes:
+    # Tables return None for stored rows that fail validation, those are left out
+    return b'[' + b','.join([entity_to_json(entity) for entity in entities if entity is not None]) + b']'
+
+
+def serialize_all(datasource: DataSource, datatype: str) -> bytes:
+    table = datasource.get_table(datatype)
+    if isinstance(table, AppendLogTable):
+        # Every payload in the log was written from Entity.serialize() of this table
+        return table.serialize_all()
+    return dump_entities(datasource.get_all(datatype) or [])
+
+
+def json_response(content: bytes) -> Response:
+    return Response(content, media_type='application/json')
+
+
+def get_datasource_limiter(datasource: DataSource) -> anyio.CapacityLimiter:
+    # One limiter per datasource for the whole process, it is shared by every event loop that serves the datasource
+    limiter = datasource_limiters.get(datasource)
+    if limiter is None:
+        limiter = datasource_limiters.setdefault(datasource, anyio.CapacityLimiter(1))
+    return limiter
+
+
+async def run_in_thread(datasource: DataSource, func: Callable, *args):
+    """Run a blocking datasource call in a worker thread so the event loop keeps serving, one call at a time per datasource"""
+
+    # Waiting calls queue on the limiter in the event loop instead of holding a thread of the shared pool
+    return await anyio.to_thread.run_sync(func, *args, limiter=get_datasource_limiter(datasource))
+
+
+def get_id_type(datasource: DataSource) -> type:
+    if not datasource.auto_increment:
+        return int | str
+    return int if datasource.id_type == IdTypes.INT else str
+
+
+def create_id_generator(id_type: IdTypes, count: int) -> Callable[[], int | str]:
+    """Ids in the format DataSource.insert generates them, for a table that already holds count rows"""
+
+    if id_type == IdTypes.INT:
+        return itertools.count(count + 1).__next__
+    if id_type == IdTypes.UUID:
+        return lambda: str(uuid.uuid4())
+    return lambda: ''.join(random.choices(string.ascii_letters + string.digits, k=16))
 
 
 def convert2int(value: str) -> bool:
-    try:
-        int(value)
-        return True
-    except ValueError:
-        return False
+    digits = value[1:] if value[:1] in ('-', '+') else value
+    return digits.isdecimal()
+
+
+class ResponseCache:
+    __slots__ = ('all', 'by_id', 'by_filter', 'version')
+
+    def __init__(self):
+        self.all = None  # type: bytes | None
+        self.by_id = {}  # type: dict[int | str, bytes]
+        self.by_filter = {}  # type: dict[tuple, bytes]
+        # Bumped on every clear, a read that started before a write must not store its result
+        self.version = 0
+
+    def clear(self):
+        self.version += 1
+        self.all = None
+        self.by_id.clear()
+        self.by_filter.clear()
 
 
 class CRUDApiRouter:
     def __init__(self, datasource: DataSource, name: str, model_type: type, factory: EntityFactory, use_prefix: bool = True, use_name_as_tag: bool = True, filters: list[FieldBase] = []):
         self.__datasource = datasource
         self.__is_included = False
+        # Handlers below use these locals instead of looking the attributes up on self for every request
+        cache = self.__cache = ResponseCache()
+        # Generated ids have a known type, FastAPI parses those so only mixed ids are converted per request
+        id_type = get_id_type(datasource)
+        convert_ids = id_type is not int and id_type is not str
         self.name = name
         self.use_prefix = use_prefix
         self.use_name_as_tag = use_name_as_tag
         datatype = name.lower()
         tags = get_tags(name, use_name_as_tag)
-        table = self.__datasource.get_table(datatype)
+        table = datasource.get_table(datatype)
         if not table:
             raise ValueError(f'Table {datatype} not found in datasource')
+        field_structure = table.field_structure
 
         base_path = f'/{datatype}'
+        list_path = construct_path(base_path, '', True, use_prefix)
+        filter_path = construct_path(base_path, '/filter', True, use_prefix)
+        single_path = construct_path(base_path, '', False, use_prefix)
+        bulk_path = construct_path(base_path, '/bulk', False, use_prefix)
+        item_path = construct_path(base_path, id_path, False, use_prefix)
+
+        route_options = {'tags': tags, 'response_class': ORJSONResponse, 'response_model': None}
+        # msgspec structs are decoded and validated straight from the raw body, pydantic models are left to FastAPI
+        if is_struct_type(model_type):
+            body = Depends(create_struct_decoder(model_type))
+            bulk_body = Depends(create_struct_decoder(List[model_type]))
+            body_options = dict(route_options, openapi_extra=create_struct_request_body(model_type))
+            bulk_body_options = dict(route_options, openapi_extra=create_struct_request_body(List[model_type]))
+        else:
+            body = Body()
+            bulk_body = Body()
+            body_options = bulk_body_options = route_options
 
         self.__router = APIRouter(
-            prefix=get_prefix(datatype, use_prefix)
+            prefix=get_prefix(datatype, use_prefix),
+            default_response_class=ORJSONResponse
         )
 
-        @self.__router.get(construct_path(f'{base_path}', '', True, use_prefix), tags=tags)
+        @self.__router.get(list_path, **route_options)
         async def read_items():
-            return format_entities(self.__datasource.get_all(datatype) or [])
+            content = cache.all
+            if content is None:
+                version = cache.version
+                content = await run_in_thread(datasource, serialize_all, datasource, datatype)
+                if cache.version == version:
+                    cache.all = content
+            return json_response(content)
         
         if len(filters) > 0:
             filter_dict = convert_field_to_filter(filters)
-
-            @self.__router.get(construct_path(f'{base_path}', '/filter', True, use_prefix), tags=tags)
-            async def filter_items(params: create_model("Query", **filter_dict) = Depends()):
-                fields = params.dict()
-                processed_filters = convert_dict_to_filter(fields)
-                result = format_entities(self.__datasource.get_by_filter(datatype, processed_filters) or [])
-                return result
-
-        @self.__router.get(construct_path(base_path, id_path, False, use_prefix), tags=tags)
-        async def read_item(id: int | str):
-            return self.__datasource.get_by_id(datatype, id)
-
-        @self.__router.post(construct_path(base_path, '', False, use_prefix), tags=tags)
-        async def create_item(item: model_type):
+            query_model = create_model("Query", **filter_dict)
+            filter_keys = tuple(filter_dict)
+            build_filter = create_filter_builder(filter_keys)
+
+            def load_filtered(params) -> bytes:
+                return dump_entities(datasource.get_by_filter(datatype, build_filter(params)) or [])
+
+            @self.__router.get(filter_path, **route_options)
+            async def filter_items(params: query_model = Depends()):
+                key = tuple(getattr(params, name) for name in filter_keys)
+                cached = cache.by_filter.get(key)
+                if cached is None:
+                    version = cache.version
+                    cached = await run_in_thread(datasource, load_filtered, params)
+                    if cache.version != version:
+                        return json_response(cached)
+                    if len(cache.by_filter) >= cache_size:
+                        cache.by_filter.clear()
+                    cache.by_filter[key] = cached
+                return json_response(cached)
+
+        def load_item(id: int | str) -> bytes:
+            entity = datasource.get_by_id(datatype, id)
+            return entity_to_json(entity) if entity else b'null'
+
+        @self.__router.get(item_path, **route_options)
+        async def read_item(id: id_type):
+            if convert_ids and convert2int(id):
+                id = int(id)
+            cached = cache.by_id.get(id)
+            if cached is None:
+                version = cache.version
+                cached = await run_in_thread(datasource, load_item, id)
+                if cache.version != version:
+                    return json_response(cached)
+                if len(cache.by_id) >= cache_size:
+                    cache.by_id.clear()
+                cache.by_id[id] = cached
+            return json_response(cached)
+
+        @self.__router.post(single_path, **body_options)
+        async def create_item(item: model_type = body):
             try:
-                entity = factory.create_entity(table.field_structure, item.model_dump())
-                result = self.__datasource.insert(datatype, entity)
+                entity = factory.from_model(field_structure, item)
+                result = await run_in_thread(datasource, datasource.insert, datatype, entity)
+                cache.clear()
                 if result:
-                    return {'success': True, 'created_entity': result.serialize()}
+                    return ORJSONResponse({'success': True, 'created_entity': result.serialize()})
                 else:
-                    return {'success': False}
+                    return ORJSONResponse({'success': False})
+            except Exception as e:
+                return ORJSONResponse({'success': False, 'error': str(e)})
+
+        def insert_all(items: list, created: list[dict]):
+            entities = [factory.from_model(field_structure, item) for item in items]
+            count = count_rows(table)
+            if count is None or type(datasource).insert is not DataSource.insert:
+                # Ids come from DataSource.insert here, which reads the whole table for each of them
+                with buffered_writes(datasource):
+                    for entity in entities:
+                        result = datasource.insert(datatype, entity)
+                        if result:
+                            created.append(result.serialize())
+                return
+
+            # Same ids and checks as DataSource.insert, without reading the table again for every entity
+            if datasource.auto_increment:
+                next_id = create_id_generator(datasource.id_type, count)
+                for entity in entities:
+                    entity.id = next_id()
+            else:
+                for entity in entities:
+                    if not entity.id:
+                        raise ValueError("Entity must have an id")
+                entities = [entity for entity in entities if not table.get_by_id(entity.id)]
+            stored = []
+            try:
+                insert_many(table, entities, stored)
+            finally:
+                created.extend(entity.serialize() for entity in stored)
+
+        @self.__router.post(bulk_path, **bulk_body_options)
+        async def create_items(items: List[model_type] = bulk_body):
+            # Rows inserted before a failure stay stored, so they are reported with the error as well
+            created = []
+            try:
+                await run_in_thread(datasource, insert_all, items, created)
+                cache.clear()
+                return ORJSONResponse({'success': True, 'created_entities': created})
             except Exception as e:
-                return {'success': False, 'error': str(e)}
+                cache.clear()
+                return ORJSONResponse({'success': False, 'error': str(e), 'created_entities': created})
 
-        @self.__router.put(construct_path(base_path, id_path, False, use_prefix), tags=tags)
-        async def update_item(item_id: int | str, item: model_type):
+        @self.__router.put(item_path, **body_options)
+        async def update_item(item_id: id_type, item: model_type = body):
             try:
-                entity = factory.create_entity(table.field_structure, item.model_dump())
-                if isinstance(item_id, str) and convert2int(item_id):
+                entity = factory.from_model(field_structure, item)
+                if convert_ids and convert2int(item_id):
                     item_id = int(item_id)
-                result = self.__datasource.update(datatype, item_id, entity)
+                result = await run_in_thread(datasource, datasource.update, datatype, item_id, entity)
+                cache.clear()
                 if result:
-                    return {'success': True, 'updated_entity': result.serialize()}
-                return {'success': False}
+                    return ORJSONResponse({'success': True, 'updated_entity': result.serialize()})
+                return ORJSONResponse({'success': False})
             except Exception as e:
-                return {'success': False, 'error': str(e)}
+                return ORJSONResponse({'success': False, 'error': str(e)})
 
-        @self.__router.delete(construct_path(base_path, id_path, False, use_prefix), tags=tags)
-        async def delete_item(item_id: int | str):
+        @self.__router.delete(item_path, **route_options)
+        async def delete_item(item_id: id_type):
             try:
-                if isinstance(item_id, str) and convert2int(item_id):
+                if convert_ids and convert2int(item_id):
                     item_id = int(item_id)
-                result = self.__datasource.delete(datatype, item_id)
+                result = await run_in_thread(datasource, datasource.delete, datatype, item_id)
+                cache.clear()
                 if result:
-                    return {'success': True, 'deleted_id': item_id}
-                return {'success': False}
+                    return ORJSONResponse({'success': True, 'deleted_id': item_id})
+                return ORJSONResponse({'success': False})
             except Exception as e:
-                return {'success': False, 'error': str(e)}
+                return ORJSONResponse({'success': False, 'error': str(e)})
 
-        @self.__router.delete(construct_path(base_path, '', True, use_prefix), tags=tags)
+        @self.__router.delete(list_path, **route_options)
         async def delete_all_items():
-            return self.__datasource.clear(datatype)
+            result = await run_in_thread(datasource, datasource.clear, datatype)
+            cache.clear()
+            return ORJSONResponse(result)
 
     def get_base(self):
         return self.__router
@@ -122,6 +296,11 @@ class CRUDApiRouter:
     def get_datasource(self):
         return self.__datasource
 
+    def invalidate_cache(self):
+        """Drop cached read responses, call this after writing to the table outside of the router"""
+
+        self.__cache.clear()
+
     @property
     def is_included(self):
         return self.__is_included
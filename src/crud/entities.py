@@ -1,5 +1,10 @@
 from pydantic import BaseModel
 from pyrepositories import Entity, FieldBase, EntityField
+from .lib import dump_value, dumps
+
+
+def entity_to_json(entity: Entity) -> bytes:
+    return dumps(entity.serialize())
 
 
 class EntityFactory:
@@ -18,3 +23,11 @@ class EntityFactory:
             value = data.get(field.name)
             entity_fields.append(EntityField(field, value))
         return Entity(entity_fields)
+
+    @staticmethod
+    def from_model(fields: list[FieldBase], model: BaseModel) -> Entity:
+        entity_fields = []
+        for field in fields:
+            value = dump_value(getattr(model, field.name, None))
+            entity_fields.append(EntityField(field, value))
+        return Entity(entity_fields)
@@ -1,19 +1,65 @@
+from typing import Any, Callable, Iterable
+from functools import lru_cache
+import orjson
+from fastapi import Request
+from fastapi.exceptions import RequestValidationError
 from pydantic import BaseModel
 from pyrepositories import IdTypes, FieldBase, FieldTypes, Filter, FilterCondition, FilterCombination, FilterTypes
 
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+
 
 class Model(BaseModel):
     pass
 
 
+# Non string keys are written as strings, the same as the json module does for JsonTable files
+json_options = orjson.OPT_NON_STR_KEYS
+
+
+def dump_value(value: Any) -> Any:
+    if isinstance(value, BaseModel):
+        return value.model_dump()
+    if msgspec is not None and isinstance(value, msgspec.Struct):
+        return msgspec.to_builtins(value)
+    if isinstance(value, list):
+        return [dump_value(item) for item in value]
+    return value
+
+
+def encode_default(value: Any) -> Any:
+    """orjson fallback for models left inside entity values, everything orjson knows stays in its C encoder"""
+
+    if isinstance(value, BaseModel) or (msgspec is not None and isinstance(value, msgspec.Struct)):
+        return dump_value(value)
+    raise TypeError(f'Type is not JSON serializable: {type(value).__name__}')
+
+
+def dumps(content: Any) -> bytes:
+    return orjson.dumps(content, default=encode_default, option=json_options)
+
+
 def convert_field_to_filter(fields: list[FieldBase]) -> dict:
+    key = tuple((field.name, field.field_type, field.default) for field in fields)
+    try:
+        return dict(_convert_field_to_filter(key))
+    except TypeError:
+        # Unhashable defaults cannot be cached
+        return dict(_convert_field_to_filter.__wrapped__(key))
+
+
+@lru_cache(maxsize=256)
+def _convert_field_to_filter(fields: tuple) -> dict:
     filter_dict = {}
-    for field in fields:
-        if field.field_type.content_type == FieldTypes.LIST:
+    for name, field_type, default in fields:
+        if field_type.content_type == FieldTypes.LIST:
             raise ValueError('Field type LIST is not supported')
-        if field.field_type.content_type == FieldTypes.DICT:
+        if field_type.content_type == FieldTypes.DICT:
             raise ValueError('Field type DICT is not supported')
-        filter_dict[field.name] = (field.field_type.content_type, field.default)
+        filter_dict[name] = (field_type.content_type, default)
     return filter_dict
 
 
@@ -24,3 +70,56 @@ def convert_dict_to_filter(data: dict) -> Filter:
         conditions.append(FilterCondition(key, value, FilterTypes.CONTAINS))
 
     return Filter(conditions, FilterCombination.AND)
+
+
+def create_filter_builder(keys: Iterable[str]) -> Callable[[BaseModel], Filter]:
+    keys = tuple(keys)
+
+    def build_filter(params: BaseModel) -> Filter:
+        conditions = [FilterCondition(key, getattr(params, key), FilterTypes.CONTAINS) for key in keys]
+        return Filter(conditions, FilterCombination.AND)
+
+    return build_filter
+
+
+def is_struct_type(model_type: type) -> bool:
+    return msgspec is not None and isinstance(model_type, type) and issubclass(model_type, msgspec.Struct)
+
+
+def create_struct_decoder(model_type: type) -> Callable[[Request], Any]:
+    decoder = msgspec.json.Decoder(model_type)
+
+    async def decode_body(request: Request):
+        try:
+            return decoder.decode(await request.body())
+        except msgspec.DecodeError as e:
+            raise RequestValidationError([{'type': 'value_error', 'loc': ('body',), 'msg': str(e), 'input': None}])
+
+    return decode_body
+
+
+def _inline_refs(schema: Any, components: dict, seen: frozenset = frozenset()) -> Any:
+    if isinstance(schema, list):
+        return [_inline_refs(item, components, seen) for item in schema]
+    if not isinstance(schema, dict):
+        return schema
+    ref = schema.get('$ref')
+    if ref is not None:
+        name = ref.rsplit('/', 1)[-1]
+        if name in seen:
+            # Recursive struct, a reference cannot be resolved outside of msgspec's own components
+            return {}
+        return _inline_refs(components[name], components, seen | {name})
+    return {key: _inline_refs(value, components, seen) for key, value in schema.items()}
+
+
+def create_struct_request_body(model_type: Any) -> dict:
+    """OpenAPI requestBody for a struct body, FastAPI cannot see it through the decoding dependency"""
+
+    (schema,), components = msgspec.json.schema_components([model_type])
+    return {
+        'requestBody': {
+            'required': True,
+            'content': {'application/json': {'schema': _inline_refs(schema, components)}},
+        }
+    }
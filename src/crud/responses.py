@@ -0,0 +1,8 @@
+from typing import Any
+from fastapi.responses import JSONResponse
+from .lib import dumps
+
+
+class ORJSONResponse(JSONResponse):
+    def render(self, content: Any) -> bytes:
+        return dumps(content)
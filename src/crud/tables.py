@@ -0,0 +1,482 @@
+import mmap
+import os
+import struct
+import threading
+from contextlib import contextmanager, ExitStack
+from enum import Enum
+from typing import Any
+import orjson
+from pyrepositories import DataSource, DataTable, JsonTable, Entity, FieldBase, FieldTypes, Filter, FilterCombination, FilterTypes
+from pyrepositories.json_repository import convert_to_entity
+from .lib import dumps
+
+indexable_types = (FieldTypes.STR, FieldTypes.UUID, FieldTypes.INT, FieldTypes.BOOL, FieldTypes.FLOAT)
+indexed_filter_types = (FilterTypes.EQUAL, FilterTypes.CONTAINS, FilterTypes.LIKE)
+
+
+class IndexedJsonTable(JsonTable):
+    """JsonTable that keeps an in-memory value -> ids index of its scalar fields to answer filters without a full scan"""
+
+    def __init__(self, name: str, store_path: str, fields: list[FieldBase], create_if_not_exists: bool = True, indexed_fields: list[str] | None = None):
+        super().__init__(name, store_path, fields, create_if_not_exists)
+        if indexed_fields is None:
+            indexed_fields = [field.name for field in fields if field.field_type in indexable_types]
+        self.indexed_fields = indexed_fields
+        self._index = {}  # type: dict[str, dict[Any, set[int | str]]]
+        self._values = {}  # type: dict[int | str, dict[str, Any]]
+        self._buffered = 0
+        self._pending = False
+        self._rebuild_index()
+
+    def insert(self, data: Entity) -> Entity | None:
+        # Every stored id has an entry in _values, the base insert decodes the whole table to find duplicates
+        if data.id in self._values:
+            raise ValueError("Entity already exists")
+        result = self._insert(data, [])
+        if not result:
+            return None
+        row = result.serialize()
+        content = self.json_service.read('content')
+        content.append(row)
+        self._store(content)
+        self._index_row(row)
+        return result
+
+    def update(self, entity_id, data: Entity) -> Entity | None:
+        # JsonTable.update ends in the DataTable stub and never stores the row
+        if entity_id not in self._values:
+            return None
+        data.id = entity_id
+        replace_field_values(self, entity_id, data)
+        row = data.serialize()
+        content = self.json_service.read('content')
+        for index, item in enumerate(content):
+            if item['id'] == entity_id:
+                content[index] = row
+                break
+        self._store(content)
+        self._unindex_row(entity_id)
+        self._index_row(row)
+        return data
+
+    def delete(self, entity_id) -> bool:
+        if entity_id not in self._values:
+            return False
+        content = self.json_service.read('content')
+        for index, item in enumerate(content):
+            if item['id'] == entity_id:
+                del content[index]
+                break
+        self._store(content)
+        replace_field_values(self, entity_id, None)
+        self._unindex_row(entity_id)
+        return True
+
+    def clear(self):
+        result = super().clear()
+        self._rebuild_index()
+        return result
+
+    def count(self) -> int:
+        return len(self._values)
+
+    @contextmanager
+    def buffered(self):
+        """Write the file once when the block exits instead of after every insert, update and delete"""
+
+        self._buffered += 1
+        try:
+            yield self
+        finally:
+            self._buffered -= 1
+            if not self._buffered and self._pending:
+                self._pending = False
+                self.json_service.write('content', self.json_service.read('content'))
+
+    def _store(self, content: list[dict]):
+        if self._buffered:
+            self._pending = True
+        else:
+            self.json_service.write('content', content)
+
+    def get_by_filter(self, filters: Filter) -> list[Entity]:
+        ids = self._match_ids(filters)
+        if ids is NotImplemented:
+            return super().get_by_filter(filters)
+
+        content = self.json_service.read('content') or []
+        if ids is None:
+            return [convert_to_entity(item, self.field_structure) for item in content]
+        return [convert_to_entity(item, self.field_structure) for item in content if item['id'] in ids]
+
+    def _match_ids(self, filters: Filter) -> set | None:
+        """Matching ids, None when every row matches, NotImplemented when the index cannot answer the filter"""
+
+        if filters.combination != FilterCombination.AND:
+            return NotImplemented
+
+        ids = None
+        for condition in filters.conditions:
+            if condition.key not in self.fields:
+                # Entity.matches_condition returns False for a key the entity does not have, so no row matches
+                return set()
+            value = condition.value
+            # Same as Entity.matches_condition, an empty or default value does not restrict the result
+            if value is None or value == '' or value == [] or value == self.fields[condition.key].default:
+                continue
+            if condition.key not in self._index or condition.filter_type not in indexed_filter_types:
+                return NotImplemented
+
+            index = self._index[condition.key]
+            if condition.filter_type == FilterTypes.EQUAL:
+                try:
+                    matched = index.get(value, set())
+                except TypeError:
+                    # Unhashable value, only the full scan can compare it
+                    return NotImplemented
+            elif not isinstance(value, str):
+                return NotImplemented
+            else:
+                matched = set()
+                for indexed_value, value_ids in index.items():
+                    if isinstance(indexed_value, str) and value in indexed_value:
+                        matched |= value_ids
+
+            ids = matched if ids is None else ids & matched
+            if not ids:
+                return ids
+        return ids
+
+    def _rebuild_index(self):
+        self._index = {name: {} for name in self.indexed_fields}
+        self._values = {}
+        for item in self.json_service.read('content') or []:
+            self._index_row(item)
+
+    def _index_row(self, item: dict):
+        entity_id = item['id']
+        values = {}
+        for name, index in list(self._index.items()):
+            value = item.get(name)
+            if value is None:
+                value = self.fields[name].default
+            try:
+                index.setdefault(value, set()).add(entity_id)
+            except TypeError:
+                # Unhashable value, filters on this field fall back to the full scan
+                self._drop_index(name)
+                continue
+            values[name] = value
+        self._values[entity_id] = values
+
+    def _drop_index(self, name: str):
+        self.indexed_fields = [field for field in self.indexed_fields if field != name]
+        del self._index[name]
+        for values in self._values.values():
+            values.pop(name, None)
+
+    def _unindex_row(self, entity_id):
+        values = self._values.pop(entity_id, None)
+        if values is None:
+            return
+        for name, value in values.items():
+            value_ids = self._index[name].get(value)
+            if value_ids is None:
+                continue
+            value_ids.discard(entity_id)
+            if not value_ids:
+                del self._index[name][value]
+
+
+# Every log record is a one byte operation and the payload length, followed by the orjson encoded payload
+record_header = struct.Struct('>BI')
+op_put = 0
+op_delete = 1
+
+
+class AppendLogTable(DataTable):
+    """Table stored as an append-only log of length-prefixed orjson records, with an in-memory id -> offset map"""
+
+    def __init__(self, name: str, store_path: str, fields: list[FieldBase], compact_ratio: float = 1.0, compact_min_size: int = 1 << 20):
+        super().__init__(name, fields)
+        os.makedirs(store_path, exist_ok=True)
+        self.file_path = os.path.join(store_path, f'{name}.log')
+        self.compact_ratio = compact_ratio
+        self.compact_min_size = compact_min_size
+        self._offsets = {}  # type: dict[int | str, tuple[int, int]]
+        self._dead_bytes = 0
+        self._map = None  # type: mmap.mmap | None
+        self._lock = threading.RLock()
+        self._buffered = 0
+        self._writer = open(self.file_path, 'ab')
+        self._load()
+        self._refresh_fields()
+
+    def get_all(self) -> list[Entity]:
+        # A compaction from another thread replaces the offsets, look them up and read them under the same lock
+        with self._lock:
+            payloads = [self._read(*location) for location in self._offsets.values()]
+        return [self._to_entity(payload) for payload in payloads]
+
+    def get_by_id(self, entity_id: int | str) -> Entity | None:
+        with self._lock:
+            location = self._offsets.get(entity_id)
+            if location is None:
+                return None
+            payload = self._read(*location)
+        return self._to_entity(payload)
+
+    def get_unique(self, key: str, value: Any) -> Entity | None:
+        field_value = self._get_unique(key, value)
+        if not field_value:
+            return None
+        return self.get_by_id(field_value.entity_id)
+
+    def count(self) -> int:
+        return len(self._offsets)
+
+    def serialize_all(self) -> bytes:
+        """JSON array of all stored rows, copied out of the log without decoding them"""
+
+        with self._lock:
+            return b'[' + b','.join([self._read(*location) for location in self._offsets.values()]) + b']'
+
+    def insert(self, data: Entity) -> Entity | None:
+        with self._lock:
+            if data.id in self._offsets:
+                raise ValueError("Entity already exists")
+            result = self._insert(data, [])
+            if not result:
+                return None
+            self._put(data.id, data.serialize())
+            return result
+
+    def update(self, entity_id, data: Entity) -> Entity | None:
+        with self._lock:
+            if entity_id not in self._offsets:
+                return None
+            data.id = entity_id
+            replace_field_values(self, entity_id, data)
+            self._put(entity_id, data.serialize())
+            return data
+
+    def delete(self, entity_id) -> bool:
+        with self._lock:
+            location = self._offsets.pop(entity_id, None)
+            if location is None:
+                return False
+            replace_field_values(self, entity_id, None)
+            # Both the removed row and the tombstone itself are dead, the same as _load counts them
+            tombstone = orjson.dumps(entity_id)
+            self._dead_bytes += record_header.size + location[1] + record_header.size + len(tombstone)
+            self._append(op_delete, tombstone)
+            self._maybe_compact()
+            return True
+
+    def clear(self) -> bool:
+        with self._lock:
+            self._writer.truncate(0)
+            self._writer.seek(0, os.SEEK_END)
+            self._offsets = {}
+            self._dead_bytes = 0
+            self._close_map()
+            for field in self.fields.values():
+                field.values = {}
+            return True
+
+    def compact(self):
+        """Rewrite the log with only the live rows"""
+
+        with self._lock:
+            tmp_path = f'{self.file_path}.tmp'
+            offsets = {}
+            with open(tmp_path, 'wb') as tmp:
+                for entity_id, location in self._offsets.items():
+                    payload = self._read(*location)
+                    tmp.write(record_header.pack(op_put, len(payload)))
+                    offsets[entity_id] = (tmp.tell(), len(payload))
+                    tmp.write(payload)
+                tmp.flush()
+                os.fsync(tmp.fileno())
+            self._close_map()
+            self._writer.close()
+            os.replace(tmp_path, self.file_path)
+            self._writer = open(self.file_path, 'ab')
+            self._offsets = offsets
+            self._dead_bytes = 0
+
+    @contextmanager
+    def buffered(self):
+        """Flush appended records to the file once when the block exits instead of after every write"""
+
+        with self._lock:
+            self._buffered += 1
+        try:
+            yield self
+        finally:
+            with self._lock:
+                self._buffered -= 1
+                if not self._buffered:
+                    self._writer.flush()
+
+    def close(self):
+        with self._lock:
+            self._close_map()
+            self._writer.close()
+
+    def _to_entity(self, payload: bytes) -> Entity | None:
+        return convert_to_entity(orjson.loads(payload), self.field_structure)
+
+    def _put(self, entity_id, row: dict):
+        previous = self._offsets.get(entity_id)
+        if previous is not None:
+            self._dead_bytes += record_header.size + previous[1]
+        self._offsets[entity_id] = self._append(op_put, dumps(row))
+        self._maybe_compact()
+
+    def _append(self, op: int, payload: bytes) -> tuple[int, int]:
+        start = self._writer.tell() + record_header.size
+        self._writer.write(record_header.pack(op, len(payload)) + payload)
+        if not self._buffered:
+            self._writer.flush()
+        return start, len(payload)
+
+    def _read(self, start: int, length: int) -> bytes:
+        with self._lock:
+            if self._map is None or len(self._map) < start + length:
+                self._writer.flush()
+                self._close_map()
+                with open(self.file_path, 'rb') as file:
+                    self._map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+            return self._map[start:start + length]
+
+    def _close_map(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+
+    def _load(self):
+        size = os.path.getsize(self.file_path)
+        if size == 0:
+            return
+        with open(self.file_path, 'rb') as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as log:
+            position = 0
+            while position + record_header.size <= size:
+                op, length = record_header.unpack_from(log, position)
+                start = position + record_header.size
+                if start + length > size:
+                    break
+                if op == op_put:
+                    entity_id = orjson.loads(log[start:start + length])['id']
+                    previous = self._offsets.get(entity_id)
+                    if previous is not None:
+                        self._dead_bytes += record_header.size + previous[1]
+                    self._offsets[entity_id] = (start, length)
+                else:
+                    previous = self._offsets.pop(orjson.loads(log[start:start + length]), None)
+                    if previous is not None:
+                        self._dead_bytes += record_header.size + previous[1]
+                    self._dead_bytes += record_header.size + length
+                position = start + length
+        if position < size:
+            # Drop a record that was cut short by a crash in the middle of a write
+            self._writer.truncate(position)
+            self._writer.seek(0, os.SEEK_END)
+
+    def _maybe_compact(self):
+        size = self._writer.tell()
+        if size >= self.compact_min_size and self._dead_bytes >= (size - self._dead_bytes) * self.compact_ratio:
+            self.compact()
+
+
+def replace_field_values(table: DataTable, entity_id, entity: Entity | None):
+    """Keep the TableField values of a row in step after an update, or drop them when entity is None"""
+
+    previous = {name: field.values.pop(entity_id, None) for name, field in table.fields.items()}
+    if entity is None:
+        return
+    try:
+        # Records every field value and checks the UNIQUE fields, the same as an insert does
+        table._insert(entity, [])
+    except Exception:
+        for name, value in previous.items():
+            table.fields[name].values.pop(entity_id, None)
+            if value is not None:
+                table.fields[name].values[entity_id] = value
+        raise
+
+
+class TableStorage(Enum):
+    JSON = 'json'
+    INDEXED_JSON = 'indexed_json'
+    APPEND_LOG = 'append_log'
+
+
+def create_table(name: str, store_path: str, fields: list[FieldBase], storage: TableStorage = TableStorage.JSON) -> DataTable:
+    if storage == TableStorage.INDEXED_JSON:
+        return IndexedJsonTable(name, store_path, fields)
+    if storage == TableStorage.APPEND_LOG:
+        return AppendLogTable(name, store_path, fields)
+    return JsonTable(name, store_path, fields)
+
+
+def count_rows(table: DataTable) -> int | None:
+    """Number of stored rows without decoding them, None when the table cannot tell"""
+
+    if isinstance(table, (IndexedJsonTable, AppendLogTable)):
+        return table.count()
+    if isinstance(table, JsonTable):
+        return len(table.json_service.read('content') or [])
+    return None
+
+
+def insert_many(table: DataTable, entities: list[Entity], created: list[Entity]):
+    """Insert entities that already have their ids with a single file write, appending the stored ones to created
+
+    A JsonTable stores none of them when one is rejected, the other tables keep the ones inserted before it.
+    """
+
+    if isinstance(table, (IndexedJsonTable, AppendLogTable)):
+        with table.buffered():
+            for entity in entities:
+                result = table.insert(entity)
+                if result:
+                    created.append(result)
+        return
+    if not isinstance(table, JsonTable):
+        for entity in entities:
+            result = table.insert(entity)
+            if result:
+                created.append(result)
+        return
+
+    # JsonTable.insert decodes and rewrites the whole file for every row, so the batch is checked and stored at once
+    content = table.json_service.read('content') or []
+    stored_ids = {item['id'] for item in content}
+    accepted = []
+    try:
+        for entity in entities:
+            if entity.id in stored_ids:
+                raise ValueError("Entity already exists")
+            accepted.append(entity)
+            table._insert(entity, [])
+            stored_ids.add(entity.id)
+        table.json_service.write('content', content + [entity.serialize() for entity in accepted])
+    except Exception:
+        for entity in accepted:
+            replace_field_values(table, entity.id, None)
+        raise
+    created.extend(accepted)
+
+
+@contextmanager
+def buffered_writes(datasource: DataSource):
+    """Coalesce the file writes of the IndexedJsonTable and AppendLogTable tables in the datasource until the block exits"""
+
+    # A plain JsonTable writes inside every call and cannot defer it, insert_many batches inserts into one
+
+    with ExitStack() as stack:
+        for table in datasource.tables:
+            if isinstance(table, (IndexedJsonTable, AppendLogTable)):
+                stack.enter_context(table.buffered())
+        yield datasource